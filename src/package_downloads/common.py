@@ -1,5 +1,6 @@
-from asyncio import gather
-from typing import Any, Callable, Iterable, Sequence, TypeVar
+from asyncio import Semaphore, TaskGroup
+from contextlib import AbstractAsyncContextManager, nullcontext
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Sequence, TypeVar
 from urllib.parse import quote as urllib_quote, unquote as urllib_unquote
 
 BASE_DIR = "package-downloads"
@@ -29,5 +30,18 @@ def unescape_path(path: str) -> str:
 T = TypeVar("T")
 
 
-async def gather_map(func: Callable[..., T], it: Iterable[Any]) -> Any:
-    return await gather(*map(func, it))  # type: ignore
+async def gather_map(
+    func: Callable[..., Awaitable[T]], it: Iterable[Any], limit: Optional[int] = None
+) -> List[T]:
+    semaphore: AbstractAsyncContextManager[Any] = (
+        Semaphore(limit) if limit is not None else nullcontext()
+    )
+
+    async def call(arg: Any) -> T:
+        async with semaphore:
+            return await func(arg)
+
+    # TaskGroup cancels the remaining calls as soon as one of them fails.
+    async with TaskGroup() as task_group:
+        tasks = [task_group.create_task(call(arg)) for arg in it]
+    return [task.result() for task in tasks]
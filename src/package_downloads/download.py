@@ -1,19 +1,96 @@
-from asyncio import sleep
+from asyncio import get_running_loop, sleep
+from random import uniform
+from time import time
 from types import TracebackType
-from typing import Any, Dict, Optional, Type
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Type
 
-from aiohttp import ClientSession, ClientTimeout
-from aiohttp.client_exceptions import ClientResponseError
+from aiohttp import ClientResponse, ClientSession, ClientTimeout, TCPConnector
+from aiohttp.client_exceptions import (
+    ClientConnectionError,
+    ClientError,
+    ClientPayloadError,
+    ClientResponseError,
+)
+import orjson
 
-from .ntp_time import get_ntp_time
+from .ntp_time import get_ntp_time_async
+
+CONNECTION_LIMIT = 64
+CONNECTION_LIMIT_PER_HOST = 64
+MAX_RETRY_DELAY = 120
+REQUESTS_PER_SECOND = 100
+
+
+def parse_number(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    def __init__(self, requests_per_second: float) -> None:
+        self.default_interval = 1 / requests_per_second
+        self.interval = self.default_interval
+        self.next_request_time = 0.0
+
+    async def acquire(self) -> None:
+        now = get_running_loop().time()
+        request_time = max(now, self.next_request_time)
+        self.next_request_time = request_time + self.interval
+        if request_time > now:
+            await sleep(request_time - now)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        # Follow the limits the server declares, if any, else fall back to the default rate.
+        now = get_running_loop().time()
+        retry_after = parse_number(headers.get("Retry-After"))
+        if retry_after is not None:
+            self.next_request_time = max(self.next_request_time, now + retry_after)
+            return
+        remaining = parse_number(headers.get("X-RateLimit-Remaining"))
+        reset = parse_number(headers.get("X-RateLimit-Reset"))
+        if remaining is None or reset is None:
+            self.interval = self.default_interval
+            return
+        if reset > 1e9:
+            # An epoch timestamp rather than a number of seconds.
+            reset = max(0.0, reset - time())
+        if remaining < 1:
+            self.next_request_time = max(self.next_request_time, now + reset)
+        else:
+            self.interval = reset / remaining
 
 
 class Session:
     def __init__(self, date: Optional[str] = None) -> None:
-        self.client_session = ClientSession(timeout=ClientTimeout(total=15 * 60))
-        self.date = date if date is not None else get_ntp_time()
+        connector = TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+        )
+        self.client_session = ClientSession(
+            connector=connector, timeout=ClientTimeout(total=15 * 60)
+        )
+        self.rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+        self._date = date
+
+    @property
+    def date(self) -> str:
+        assert self._date is not None, "Session.date is only set once the session is entered"
+        return self._date
 
     async def __aenter__(self) -> "Session":
+        if self._date is None:
+            try:
+                self._date = await get_ntp_time_async()
+            except BaseException:
+                await self.client_session.close()
+                raise
         return self
 
     async def __aexit__(
@@ -25,23 +102,52 @@ class Session:
         await self.client_session.close()
 
 
+async def read_json(response: ClientResponse) -> Any:
+    return orjson.loads(await response.read())
+
+
+def is_transient_error(error: ClientError) -> bool:
+    if isinstance(error, ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (ClientConnectionError, ClientPayloadError))
+
+
+def get_retry_after(error: ClientError) -> Optional[str]:
+    if isinstance(error, ClientResponseError) and error.headers is not None:
+        return error.headers.get("Retry-After")
+    return None
+
+
+def get_retry_delay(retry_delay: float, attempt: int, retry_after: Optional[str] = None) -> float:
+    # Honor the server's Retry-After (in seconds) as is; retrying sooner only earns another 429.
+    # Otherwise back off exponentially with jitter, capped at MAX_RETRY_DELAY.
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+    return min(MAX_RETRY_DELAY, retry_delay * 2**attempt) + uniform(0, retry_delay)
+
+
 async def get_and_parse(
     client_session: ClientSession,
     url: str,
     headers: Optional[Dict[str, str]],
     retries: int = 0,
     retry_delay: float = 0.5,
+    parse: Callable[[ClientResponse], Awaitable[Any]] = read_json,
+    rate_limiter: Optional[RateLimiter] = None,
 ) -> Any:
-    async with client_session.get(url, headers=headers) as response:
-        while True:
-            try:
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            await rate_limiter.acquire()
+        try:
+            async with client_session.get(url, headers=headers) as response:
+                if rate_limiter is not None:
+                    rate_limiter.update(response.headers)
                 response.raise_for_status()
-            except ClientResponseError:
-                retries -= 1
-                if retries < 0:
-                    raise
-                await sleep(retry_delay)
-            else:
-                break
-        res = await response.json()
-    return res
+                return await parse(response)
+        except ClientError as e:
+            if attempt >= retries or not is_transient_error(e):
+                raise
+            delay = get_retry_delay(retry_delay, attempt, get_retry_after(e))
+        await sleep(delay)
+        attempt += 1
@@ -1,5 +1,6 @@
 #! /usr/bin/env python
 
+from asyncio import FIRST_COMPLETED, create_task, run, to_thread, wait
 from datetime import datetime
 from typing import Optional
 
@@ -7,27 +8,44 @@ from ntplib import NTPClient, NTPException
 
 from .common import DATE_FORMAT
 
+NTP_POOL = (
+    "0.pool.ntp.org",
+    "1.pool.ntp.org",
+    "2.pool.ntp.org",
+    "3.pool.ntp.org",
+)
 
-def get_ntp_time(client: Optional[NTPClient] = None, date_format: str = DATE_FORMAT) -> str:
-    ntp_pool = (
-        "0.pool.ntp.org",
-        "1.pool.ntp.org",
-        "2.pool.ntp.org",
-        "3.pool.ntp.org",
-    )
+
+async def get_ntp_time_async(
+    client: Optional[NTPClient] = None, date_format: str = DATE_FORMAT
+) -> str:
     if client is None:
         client = NTPClient()
+    # Query all servers at once and take the first answer instead of trying them in turn.
+    pending = {
+        create_task(to_thread(client.request, server, version=4, timeout=2)) for server in NTP_POOL
+    }
     errors = []
-    for server in ntp_pool:
-        try:
-            response = client.request(server, version=4, timeout=2)
-        except NTPException as e:
-            errors.append(e)
-            continue
-        time = datetime.fromtimestamp(response.tx_time)
-        return time.strftime(date_format)
+    try:
+        while pending:
+            done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+            for task in done:
+                try:
+                    response = task.result()
+                except (NTPException, OSError) as e:
+                    errors.append(e)
+                    continue
+                time = datetime.fromtimestamp(response.tx_time)
+                return time.strftime(date_format)
+    finally:
+        for task in pending:
+            task.cancel()
     raise NTPException(f"Could not get timestamp. Errors: {errors}")
 
 
+def get_ntp_time(client: Optional[NTPClient] = None, date_format: str = DATE_FORMAT) -> str:
+    return run(get_ntp_time_async(client, date_format))
+
+
 if __name__ == "__main__":
     print(get_ntp_time())
@@ -1,38 +1,42 @@
 #! /usr/bin/env python
 
-from asyncio import run
 from functools import partial
-from typing import Any, Collection, Dict, List, Optional, Set
+from typing import Collection, List, Optional, Set
 
-from aiohttp import ClientSession
+from aiohttp import ClientResponse, ClientSession
+import ijson
 
-from .common import CHANNELS, SUBDIRS, escape_path, gather_map, unescape_path
+from .common import CHANNELS, SUBDIRS, gather_map
 from .download import Session, get_and_parse
 
+PACKAGES_KEYS = ("packages", "packages.conda")
 
-async def download_repodata(
+
+async def parse_package_names(response: ClientResponse) -> Set[str]:
+    # Stream repodata.json instead of loading it whole; only the "name" of each entry is needed.
+    names: Set[str] = set()
+    name_prefix = None
+    async for prefix, event, value in ijson.parse(response.content):
+        if event == "map_key" and prefix in PACKAGES_KEYS:
+            name_prefix = f"{prefix}.{value}.name"
+        elif event == "string" and prefix == name_prefix:
+            names.add(value)
+    return names
+
+
+async def extract_package_names(
     client_session: ClientSession,
     channel_url: str,
     subdir: str,
-) -> Any:
-    return await get_and_parse(
+) -> Set[str]:
+    names: Set[str] = await get_and_parse(
         client_session,
         f"{channel_url}/{subdir}/repodata.json",
         None,
         retries=10,
         retry_delay=5,
+        parse=parse_package_names,
     )
-
-
-async def extract_package_names(
-    client_session: ClientSession,
-    channel_url: str,
-    subdir: str,
-) -> Set[str]:
-    names: Set[str] = set()
-    repodata = await download_repodata(client_session, channel_url, subdir)
-    for packages_key in ("packages", "packages.conda"):
-        names.update((package["name"] for package in repodata[packages_key].values()))
     return names
 
 
@@ -61,4 +65,6 @@ async def main(args: Optional[List[str]] = None) -> None:
 
 
 if __name__ == "__main__":
+    from uvloop import run
+
     run(main())
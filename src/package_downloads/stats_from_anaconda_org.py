@@ -1,21 +1,28 @@
 #! /usr/bin/env python
 
-from asyncio import run
+from asyncio import Task, create_task, sleep, to_thread
 from collections import defaultdict
 from functools import partial
 from itertools import islice
 from logging import INFO, basicConfig, getLogger
+from os import SEEK_END
 from pathlib import Path
-from time import sleep
-from typing import Any, Dict, Iterable, List
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 import re
 
 from aiohttp import ClientSession
-from aiohttp.client_exceptions import ClientError
+from aiohttp.client_exceptions import ClientError, ClientResponseError
 import pandas as pd
 
 from .common import BASE_DIR, CHANNELS, gather_map
-from .download import Session, get_and_parse
+from .download import (
+    RateLimiter,
+    Session,
+    get_and_parse,
+    get_retry_after,
+    get_retry_delay,
+    is_transient_error,
+)
 from .package_names import retrieve_package_names
 from ._vendor.conda.models.version import VersionOrder
 
@@ -26,6 +33,13 @@ HTTP_HEADERS = {
 }
 PACKAGE_API_URL_TEMPLATE = "https://api.anaconda.org/package/{channel}/{package}"
 PACKAGE_EXTENSION_RE = re.compile("\.tar\.bz2$|\.conda$")
+MAX_INFLIGHT = 50
+MAX_WRITES_INFLIGHT = 8
+WRITE_BATCH_SIZE = 250
+# Packages that were removed since the package names were retrieved.
+MISSING_PACKAGE_STATUSES = (404, 410)
+# Fail the run rather than publish stats if more packages than this went missing.
+MAX_MISSING_PACKAGE_FRACTION = 0.01
 
 logger = getLogger(__name__)
 log = logger.info
@@ -38,7 +52,10 @@ def chunked_lists(iterable: Iterable[Any], size: int) -> Iterable[List[Any]]:
 
 
 async def fetch_package_info(
-    client_session: ClientSession, channel: str, package: str
+    client_session: ClientSession,
+    channel: str,
+    package: str,
+    rate_limiter: Optional[RateLimiter] = None,
 ) -> Dict[str, Any]:
     url = PACKAGE_API_URL_TEMPLATE.format(channel=channel, package=package)
     headers = HTTP_HEADERS
@@ -48,90 +65,146 @@ async def fetch_package_info(
         headers,
         retries=2,
         retry_delay=1,
+        rate_limiter=rate_limiter,
     )
     return info
 
 
 async def fetch_package_download_counts(
     session: Session, channel: str, package: str
-) -> pd.DataFrame:
+) -> Optional[pd.DataFrame]:
     logger.debug("fetch_package_download_counts: %s::%s", channel, package)
-    package_info = await fetch_package_info(session.client_session, channel, package)
-    downloads = []
-    for package_file_info in package_info["files"]:
-        if "main" not in package_file_info["labels"]:
-            continue
-        if "conda" != package_file_info["type"]:
-            continue
-        downloads.append(
-            {
-                "package": package,
-                "version": package_file_info["version"],
-                "subdir": package_file_info["attrs"]["subdir"],
-                # "build": package_file_info["attrs"]["build"],
-                # "extension": PACKAGE_EXTENSION_RE.search(package_file_info["basename"])[0],
-                "total": max(0, package_file_info["ndownloads"]),
-            }
+    try:
+        package_info = await fetch_package_info(
+            session.client_session, channel, package, session.rate_limiter
         )
+    except ClientResponseError as e:
+        if e.status not in MISSING_PACKAGE_STATUSES:
+            raise
+        logger.warning("fetch_package_download_counts: %s::%s: %d", channel, package, e.status)
+        return None
+    files = [
+        package_file_info
+        for package_file_info in package_info["files"]
+        if "main" in package_file_info["labels"] and "conda" == package_file_info["type"]
+    ]
+    versions = [package_file_info["version"] for package_file_info in files]
+    subdirs = [package_file_info["attrs"]["subdir"] for package_file_info in files]
+    totals = [max(0, package_file_info["ndownloads"]) for package_file_info in files]
+    # Packages usually have far fewer distinct versions than files; parse each version once.
+    version_orders = {version: VersionOrder(version) for version in set(versions)}
+    order = sorted(
+        range(len(files)),
+        key=lambda i: (
+            version_orders[versions[i]],
+            # VersionOrder can be ambiguous (e.g., "1.1" == "1.01"), so compare by str, too.
+            versions[i],
+            subdirs[i],
+        ),
+    )
     return pd.DataFrame(
-        sorted(
-            downloads,
-            key=lambda e: (
-                e["package"],
-                VersionOrder(e["version"]),
-                # VersionOrder can be ambiguous (e.g., "1.1" == "1.01"), so compare by str, too.
-                e["version"],
-                e["subdir"],
-                # e["build"],
-                # e["extension"],
-            ),
-        )
+        {
+            "package": [package] * len(order),
+            "version": [versions[i] for i in order],
+            "subdir": [subdirs[i] for i in order],
+            # Keep int64 for packages without files so concatenation doesn't turn totals to float.
+            "total": pd.Series([totals[i] for i in order], dtype="int64"),
+        }
     )
 
 
+async def try_fetch_package_download_counts(
+    session: Session, channel: str, package: str
+) -> Union[Optional[pd.DataFrame], ClientError]:
+    try:
+        return await fetch_package_download_counts(session, channel, package)
+    except ClientError as e:
+        return e
+
+
 async def get_batch_package_download_counts(
-    date: str, channel_name: str, package_names: List[str]
-) -> Iterable[pd.DataFrame]:
+    session: Session, channel_name: str, package_names: List[str]
+) -> Iterable[Optional[pd.DataFrame]]:
     retries_per_chunk = 2
-    retry_delay = 60
+    retry_delay = 5
     retry = 0
+    counts: Dict[str, Optional[pd.DataFrame]] = {}
+    pending_package_names = package_names
     while True:
-        try:
-            async with Session(date=date) as session:
-                return await gather_map(
-                    partial(fetch_package_download_counts, session, channel_name),
-                    package_names,
-                )
-        except ClientError:
-            if retry > retries_per_chunk:
-                raise
-            retry += 1
-            logger.exception(
-                "Got a ClientError; "
-                f"Delaying further exeuction by {retry_delay}s (retry: {retry})..."
-            )
-            # This is time.sleep, not asyncio.sleep, i.e., we halt everything.
-            sleep(retry_delay)
+        results = await gather_map(
+            partial(try_fetch_package_download_counts, session, channel_name),
+            pending_package_names,
+            limit=MAX_INFLIGHT,
+        )
+        errors: Dict[str, ClientError] = {}
+        for package, result in zip(pending_package_names, results):
+            if isinstance(result, ClientError):
+                errors[package] = result
+            else:
+                counts[package] = result
+        if not errors:
+            return [counts[package] for package in package_names]
+        # Only re-fetch the packages that failed, not the whole chunk.
+        if retry > retries_per_chunk or not all(map(is_transient_error, errors.values())):
+            raise ExceptionGroup(f"Could not fetch {len(errors)} packages", list(errors.values()))
+        delay = max(
+            get_retry_delay(retry_delay, retry, get_retry_after(e)) for e in errors.values()
+        )
+        retry += 1
+        logger.warning(
+            f"Got a ClientError for {len(errors)} packages: {', '.join(errors)}; "
+            f"Delaying further execution by {delay:.1f}s (retry: {retry})..."
+        )
+        pending_package_names = list(errors)
+        await sleep(delay)
 
 
 async def get_channel_stats(
-    date: str, channel_name: str, package_names: List[str]
+    session: Session, channel_name: str, package_names: List[str], channel_dir: Path
 ) -> pd.DataFrame:
-    chunk_size = 50
-    inter_chunk_delay = 0.5
+    chunk_size = 500
     fetch_count = 0
+    missing_count = 0
     stats_list: List[pd.DataFrame] = []
-    for chunk_package_names in chunked_lists(package_names, chunk_size):
-        stats_list.extend(
-            await get_batch_package_download_counts(date, channel_name, chunk_package_names)
+    # Write each chunk's per-package files in the background while the next chunk is fetched.
+    save_task: Optional[Task[None]] = None
+    try:
+        for chunk_package_names in chunked_lists(package_names, chunk_size):
+            chunk_stats_list: List[pd.DataFrame] = []
+            for stats in await get_batch_package_download_counts(
+                session, channel_name, chunk_package_names
+            ):
+                if stats is None:
+                    missing_count += 1
+                else:
+                    chunk_stats_list.append(stats)
+            fetch_count += len(chunk_package_names)
+            log("get_channel_stats: %s: %d of %d", channel_name, fetch_count, len(package_names))
+            if save_task is not None:
+                await save_task
+                save_task = None
+            if chunk_stats_list:
+                save_task = create_task(
+                    save_packages_stats(channel_dir, pd.concat(chunk_stats_list))
+                )
+            stats_list.extend(chunk_stats_list)
+    finally:
+        # Never leave a write behind half-done, even if fetching failed.
+        if save_task is not None:
+            await save_task
+    if missing_count > MAX_MISSING_PACKAGE_FRACTION * len(package_names):
+        raise RuntimeError(
+            f"{missing_count} of {len(package_names)} packages missing from {channel_name}"
         )
-        current_chunk_size = len(chunk_package_names)
-        fetch_count += current_chunk_size
-        log("get_channel_stats: %s: %d of %d", channel_name, fetch_count, len(package_names))
-        if current_chunk_size == chunk_size:
-            # This is time.sleep, not asyncio.sleep, i.e., we halt everything.
-            sleep(inter_chunk_delay)
-    return pd.concat(stats_list)
+    if missing_count:
+        logger.warning(
+            "get_channel_stats: %s: skipped %d missing packages", channel_name, missing_count
+        )
+    totals = pd.concat(stats_list)
+    # Few distinct values repeated across many rows; categorical codes make grouping cheaper.
+    totals["package"] = totals["package"].astype("category")
+    totals["subdir"] = totals["subdir"].astype("category")
+    return totals
 
 
 def read_tsv(path: Path, **kwargs: Any) -> pd.DataFrame:
@@ -142,50 +215,93 @@ def write_tsv(path: Path, data_frame: pd.DataFrame) -> None:
     data_frame.to_csv(path, sep="\t", lineterminator="\n", index=True)
 
 
+def format_tsv(series: pd.Series) -> str:
+    # Same output as write_tsv, without pandas' per-call overhead for these few-row series.
+    lines = [f"{series.index.name}\t{series.name}"]
+    lines.extend(f"{key}\t{value}" for key, value in series.items())
+    lines.append("")
+    return "\n".join(lines)
+
+
+def append_tsv_row(path: Path, row: Dict[str, Any]) -> bool:
+    with path.open("r+") as tsv_file:
+        columns = tsv_file.readline().rstrip("\n").split("\t")
+        if not row.keys() <= set(columns):
+            return False
+        tsv_file.seek(0, SEEK_END)
+        tsv_file.write("\t".join(str(row.get(column, "")) for column in columns) + "\n")
+    return True
+
+
+def write_packages_stats(
+    versions_dir: Path,
+    platforms_dir: Path,
+    packages_totals: List[Tuple[str, pd.Series, pd.Series]],
+) -> None:
+    for package, version_totals, subdir_totals in packages_totals:
+        (versions_dir / f"{package}.tsv").write_text(format_tsv(version_totals))
+        (platforms_dir / f"{package}.tsv").write_text(format_tsv(subdir_totals))
+
+
 async def save_packages_stats(channel_dir: Path, totals: pd.DataFrame) -> None:
-    log("save_packages_stats: %s", channel_dir.name)
-    packages_totals = totals.groupby("package", sort=True)
-    write_tsv(channel_dir / "packages.tsv", packages_totals["total"].sum())
+    log("save_packages_stats: %s: packages %d", channel_dir.name, totals["package"].nunique())
+    # Aggregate the per-file rows once; the per-package splits below then work on these sums.
+    version_totals = (
+        totals.groupby(["package", "version"], sort=False, observed=True)["total"].sum()
+    )
+    subdir_totals = totals.groupby(["package", "subdir"], sort=False, observed=True)["total"].sum()
 
     versions_dir = channel_dir / "versions"
     versions_dir.mkdir(parents=True, exist_ok=True)
     platforms_dir = channel_dir / "platforms"
     platforms_dir.mkdir(parents=True, exist_ok=True)
-    for package, package_totals in packages_totals:
-        version_totals = package_totals.groupby(["version"], sort=False)
-        write_tsv(versions_dir / f"{package}.tsv", version_totals["total"].sum())
-        subdir_totals = package_totals.groupby(["subdir"], sort=False)
-        write_tsv(platforms_dir / f"{package}.tsv", subdir_totals["total"].sum())
+    package_totals = (
+        (
+            package,
+            package_version_totals.droplevel("package"),
+            package_subdir_totals.droplevel("package"),
+        )
+        for (package, package_version_totals), (_, package_subdir_totals) in zip(
+            version_totals.groupby(level="package", sort=True, observed=True),
+            subdir_totals.groupby(level="package", sort=True, observed=True),
+        )
+    )
+    # One worker thread hop per batch of packages rather than per file.
+    await gather_map(
+        partial(to_thread, write_packages_stats, versions_dir, platforms_dir),
+        chunked_lists(package_totals, WRITE_BATCH_SIZE),
+        limit=MAX_WRITES_INFLIGHT,
+    )
 
 
 async def save_historic_channel_stats(
     date: str, channel_dir: Path, totals: pd.DataFrame
 ) -> None:
-    subdirs_totals = totals.groupby("subdir", sort=True).sum(numeric_only=True)["total"]
+    subdirs_totals = totals.groupby("subdir", sort=True, observed=True)["total"].sum()
     total_dict = {"date": date, "total": totals["total"].sum()}
     total_dict.update(subdirs_totals.to_dict())
-    channel_totals = pd.DataFrame([total_dict])
     channel_tsv = channel_dir / "channel.tsv"
+    channel_totals = pd.DataFrame([total_dict])
     if channel_tsv.exists():
-        channel_totals = pd.concat([read_tsv(channel_tsv), channel_totals])
+        # Past rows never change, so only rewrite the whole file if a new subdir column is needed.
+        if await to_thread(append_tsv_row, channel_tsv, total_dict):
+            return
+        channel_totals = pd.concat([await to_thread(read_tsv, channel_tsv), channel_totals])
     channel_totals.set_index("date", inplace=True)
-    write_tsv(channel_tsv, channel_totals)
+    await to_thread(write_tsv, channel_tsv, channel_totals)
 
 
-async def save_channel_stats(date: str, channel_name: str, package_names: List[str]) -> None:
-    totals = await get_channel_stats(date, channel_name, package_names)
-
-    log("save_channel_stats: %s: entries %d", channel_name, len(totals))
-
-    channel_dir = Path(BASE_DIR) / TOP_DIR / channel_name
-    channel_dir.mkdir(parents=True, exist_ok=True)
+async def save_channel_stats(date: str, channel_dir: Path, totals: pd.DataFrame) -> None:
+    log("save_channel_stats: %s: entries %d", channel_dir.name, len(totals))
 
     await save_historic_channel_stats(date, channel_dir, totals)
 
-    subdirs_totals = totals.groupby("subdir", sort=True)
-    write_tsv(channel_dir / "subdirs.tsv", subdirs_totals["total"].sum())
+    subdirs_totals = totals.groupby("subdir", sort=True, observed=True)
+    await to_thread(write_tsv, channel_dir / "subdirs.tsv", subdirs_totals["total"].sum())
 
-    await save_packages_stats(channel_dir, totals)
+    # The per-package files were already written chunk by chunk in get_channel_stats.
+    packages_totals = totals.groupby("package", sort=True, observed=True)["total"].sum()
+    await to_thread(write_tsv, channel_dir / "packages.tsv", packages_totals)
 
 
 async def main() -> str:
@@ -195,13 +311,17 @@ async def main() -> str:
             channel_name: (await retrieve_package_names(session.client_session, channel_url))
             for channel_name, channel_url in channels.items()
         }
-        date = session.date
-    for channel_name, package_names in channel_package_names.items():
-        await save_channel_stats(date, channel_name, package_names)
-    return date
+        for channel_name, package_names in channel_package_names.items():
+            channel_dir = Path(BASE_DIR) / TOP_DIR / channel_name
+            channel_dir.mkdir(parents=True, exist_ok=True)
+            totals = await get_channel_stats(session, channel_name, package_names, channel_dir)
+            await save_channel_stats(session.date, channel_dir, totals)
+    return session.date
 
 
 if __name__ == "__main__":
+    from uvloop import run
+
     basicConfig(level=INFO)
     date = run(main())
     print(date)